@@ -1,13 +1,47 @@
 
-import time
+import asyncio
+import csv
+import functools
+import json
+import os
+import random
+import re
 import pandas as pd
 from google import genai
+from google.genai import errors
 
 # ── Configuration ──────────────────────────────────────────────────────────────
 API_KEY = "your_api_key"
 MODEL = "gemini-2.5-flash"
 RETRY_LIMIT = 3
-RETRY_DELAY = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+MAX_CONCURRENT_STUDENTS = 8
+CACHE_TTL = "3600s"
+# Explicit caches must hold at least this many tokens (gemini-2.5-flash; 2.5-pro
+# needs 4096). The default SYSTEM_PROMPT is below it, so it is sent inline.
+CACHE_MIN_TOKENS = 1024
+HISTORY_TOKEN_BUDGET = 8000
+HISTORY_KEEP_TURNS = 4
+COMPACTION_COOLDOWN_PROBLEMS = 5
+
+SUMMARY_REQUEST = (
+    "Before the next problem, summarize in a short paragraph what you have learned "
+    "about this student so far: which strategy they tend to use, the kinds of errors "
+    "they make, and how their performance has changed across problems. "
+    "This turn is an exception to the rule that every response ends with a summary "
+    "block: reply with the paragraph only and do NOT include a ---SUMMARY--- block."
+)
+
+GROUND_TRUTH_COLUMNS = ["correct_strategy", "correct_unknown", "correct_answer"]
+
+RESULT_COLUMNS = [
+    "student_id", "problem_number", "problem_text", "cluster_number",
+    "gemini_optimal_strategy", "gemini_solved_unknown", "gemini_correct_answer",
+    "correct_strategy", "correct_unknown", "correct_answer",
+    "strategy_match", "unknown_match", "answer_match",
+    "gemini_raw_response_ref",
+]
 
 SYSTEM_PROMPT = (
     "You are simulating a 7th-grade student interacting with an intelligent tutoring system (ITS) "
@@ -41,69 +75,195 @@ SYSTEM_PROMPT = (
 
 
 # ── Parsing ────────────────────────────────────────────────────────────────────
-def parse_yes_no(s: str):
-    """Extract yes/no from a string."""
-    if s is None:
-        return None
-    s = s.strip().lower()
-    if "yes" in s:
-        return "yes"
-    elif "no" in s:
-        return "no"
-    return None
+_SUMMARY_RE = re.compile(r"---SUMMARY---(.*?)(?:---END---|\Z)", re.S)
+# Tolerates list markers, markdown and quotes, e.g. '1. **optimal_strategy:** "Yes"',
+# but never looks past the end of the line for the value
+_FIELD_RE = re.compile(
+    r"^[ \t*_`-]*(?:\d+[.)][ \t*_`]*)?[\"']?"
+    r"(optimal_strategy|solved_unknown|correct_final_answer)"
+    r"[ \t*_`\"']*:[ \t*_`\"']*(yes|no)\b",
+    re.I | re.M,
+)
+_FIELD_KEYS = {
+    "optimal_strategy": "gemini_optimal_strategy",
+    "solved_unknown": "gemini_solved_unknown",
+    "correct_final_answer": "gemini_correct_answer",
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_fields(summary_block: str) -> tuple:
+    """Cached parse of a summary block's fields, in _FIELD_KEYS order."""
+    values = dict.fromkeys(_FIELD_KEYS)
+    for field in _FIELD_RE.finditer(summary_block):
+        values[field.group(1).lower()] = field.group(2).lower()
+    return tuple(values.values())
 
 
 def parse_response(response_text: str) -> dict:
     """
     Extract from Gemini's response:
       - 3 yes/no self-assessments
+    Only the short summary block is memoized, since it repeats while the
+    free-form reasoning around it does not.
+    """
+    m = _SUMMARY_RE.search(response_text)
+    if not m:
+        return dict.fromkeys(_FIELD_KEYS.values())
+    return dict(zip(_FIELD_KEYS.values(), _parse_fields(m.group(1))))
+
+
+# ── Context Caching ────────────────────────────────────────────────────────────
+class PromptCache:
+    """
+    The server-side cache holding SYSTEM_PROMPT, shared by every session.
+    `name` is None when the prompt is sent inline instead, either because no
+    cache was created or because it expired or was deleted mid-run.
     """
-    result = {
-        "gemini_optimal_strategy": None,
-        "gemini_solved_unknown": None,
-        "gemini_correct_answer": None
-    }
 
-    if "---SUMMARY---" not in response_text:
-        return result
+    def __init__(self, name=None):
+        self.name = name
+
+    def config(self):
+        """Reference the cached system prompt, or fall back to an inline one."""
+        if self.name is not None:
+            return {"cached_content": self.name}
+        return {"system_instruction": SYSTEM_PROMPT}
+
+    @staticmethod
+    def is_missing_error(config, error: Exception) -> bool:
+        """
+        An expired or deleted cache comes back as 403/404 on generate_content.
+        Checked against the config the request was sent with, since another
+        session may already have dropped the shared cache.
+        """
+        return (
+            "cached_content" in config
+            and isinstance(error, errors.ClientError)
+            and error.code in (403, 404)
+        )
+
+    def drop(self, error: Exception):
+        if self.name is not None:
+            print(f"[Cache] Cached system prompt unavailable, sending it inline: {error}")
+            self.name = None
+
+
+async def create_prompt_cache(client, model) -> PromptCache:
+    """
+    Cache SYSTEM_PROMPT server-side so it is prefilled once per run instead of
+    once per student. Caching is skipped when the prompt is below
+    CACHE_MIN_TOKENS (~4 characters per token) or the cache cannot be created.
+    """
+    if len(SYSTEM_PROMPT) // 4 < CACHE_MIN_TOKENS:
+        return PromptCache()
+    try:
+        cache = await client.aio.caches.create(
+            model=model,
+            config={"system_instruction": SYSTEM_PROMPT, "ttl": CACHE_TTL},
+        )
+        return PromptCache(cache.name)
+    except Exception as e:
+        print(f"[Cache] Context caching unavailable, sending system prompt inline: {e}")
+        return PromptCache()
+
 
-    block = response_text.split("---SUMMARY---")[1]
-    if "---END---" in block:
-        block = block.split("---END---")[0]
+async def delete_prompt_cache(client, prompt_cache: PromptCache):
+    """Best-effort cleanup; the cache may already have expired."""
+    if prompt_cache.name is None:
+        return
+    try:
+        await client.aio.caches.delete(name=prompt_cache.name)
+    except Exception as e:
+        print(f"[Cache] Could not delete {prompt_cache.name}: {e}")
 
-    for line in block.strip().splitlines():
-        line_stripped = line.strip()
-        line_lower = line_stripped.lower()
-        val_part = line_stripped.split(":")[-1].strip()
 
-        # Yes/no self-assessments
-        if "optimal_strategy" in line_lower:
-            result["gemini_optimal_strategy"] = parse_yes_no(val_part)
+# ── Retry Policy ───────────────────────────────────────────────────────────────
+def is_retryable(error: Exception) -> bool:
+    """Timeouts (408), rate limits (429) and 5xx are transient; other 4xx are not."""
+    if isinstance(error, errors.ClientError):
+        return error.code in (408, 429)
+    # ServerError and network-level failures are worth another attempt
+    return True
 
-        elif "solved_unknown" in line_lower:
-            result["gemini_solved_unknown"] = parse_yes_no(val_part)
 
-        elif "correct_final_answer" in line_lower:
-            result["gemini_correct_answer"] = parse_yes_no(val_part)
+def retry_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2^attempt)]."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
 
-    return result
+
+# ── Conversation History ───────────────────────────────────────────────────────
+def _turn_chars(turn) -> int:
+    return sum(len(part["text"]) for part in turn["parts"])
+
+
+class ConversationHistory:
+    """
+    A session's turns plus a running character count, so checking the history
+    size before each problem is O(1) instead of a re-walk of every turn.
+    `turns` is the plain list handed to generate_content.
+    """
+
+    def __init__(self, turns=()):
+        self.turns = []
+        self._chars = 0
+        for turn in turns:
+            self.append(turn)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def append(self, turn):
+        self.turns.append(turn)
+        self._chars += _turn_chars(turn)
+
+    def replace_prefix(self, end, turns):
+        """Replace turns[:end] with `turns`."""
+        removed = sum(_turn_chars(turn) for turn in self.turns[:end])
+        self.turns[:end] = turns
+        self._chars += sum(_turn_chars(turn) for turn in turns) - removed
+
+    @property
+    def estimated_tokens(self) -> int:
+        """Rough token count (~4 characters per token) used to trigger compaction."""
+        return self._chars // 4
 
 
 # ── Core Pipeline ──────────────────────────────────────────────────────────────
-def call_gemini(client, model, conversation_history, message_text):
-    """Send a message and get a response, with retry logic."""
-    conversation_history.append({
-        "role": "user",
-        "parts": [{"text": message_text}],
-    })
+async def generate(client, model, contents, prompt_cache):
+    """generate_content, retried once with the inline prompt if the cache is gone."""
+    config = prompt_cache.config()
+    try:
+        return await client.aio.models.generate_content(
+            model=model, contents=contents, config=config,
+        )
+    except errors.ClientError as e:
+        if not prompt_cache.is_missing_error(config, e):
+            raise
+        prompt_cache.drop(e)
+        return await client.aio.models.generate_content(
+            model=model, contents=contents, config=prompt_cache.config(),
+        )
+
+
+async def call_gemini(client, model, conversation_history, message_text, prompt_cache):
+    """
+    Send a message and get a response, with retry logic.
+    The history is only extended once a response arrives, so a failed call
+    leaves it untouched.
+    """
+    user_turn = {"role": "user", "parts": [{"text": message_text}]}
 
     for attempt in range(RETRY_LIMIT):
         try:
-            response = client.models.generate_content(
-                model=model,
-                contents=conversation_history,
+            response = await generate(
+                client, model, conversation_history.turns + [user_turn], prompt_cache
             )
             response_text = response.text
+            if response_text is None:
+                # e.g. a blocked candidate; treat like any other failed attempt
+                raise ValueError("Gemini returned no text")
+            conversation_history.append(user_turn)
             conversation_history.append({
                 "role": "model",
                 "parts": [{"text": response_text}],
@@ -111,39 +271,82 @@ def call_gemini(client, model, conversation_history, message_text):
             return response_text
         except Exception as e:
             print(f"    [Retry {attempt + 1}/{RETRY_LIMIT}] Error: {e}")
+            if not is_retryable(e):
+                print("    [FAILED] Non-retryable error, skipping this call.")
+                return None
             if attempt < RETRY_LIMIT - 1:
-                time.sleep(RETRY_DELAY)
+                await asyncio.sleep(retry_delay(attempt))
             else:
                 print("    [FAILED] Skipping this call.")
                 return None
 
 
-def run_student_session(client, model, student_problems: pd.DataFrame) -> list[dict]:
+async def compact_history(client, model, conversation_history, prompt_cache):
+    """
+    Once the history exceeds HISTORY_TOKEN_BUDGET, replace all but the last
+    HISTORY_KEEP_TURNS turns with a model-written trajectory summary so that
+    per-call prefill stays bounded. Returns False, leaving the history
+    unchanged, only if the summary call failed.
+    """
+    if conversation_history.estimated_tokens <= HISTORY_TOKEN_BUDGET:
+        return True
+    split = len(conversation_history) - HISTORY_KEEP_TURNS
+    if split <= 2:
+        return True
+
+    older = ConversationHistory(conversation_history.turns[:split])
+    summary = await call_gemini(client, model, older, SUMMARY_REQUEST, prompt_cache)
+    if summary is None:
+        return False
+
+    # call_gemini appended the request/summary exchange to `older`; keeping it
+    # as a user/model pair means turns still alternate
+    conversation_history.replace_prefix(split, older.turns[-2:])
+    return True
+
+
+async def run_student_session(
+    client, model, student_problems: pd.DataFrame, prompt_cache, raw_log=None
+) -> list[dict]:
     """
     Run one session for a single student (group of problems in order).
-    Returns a list of result dicts, one per problem.
+    Returns a list of result dicts, one per problem. Raw responses are written
+    to `raw_log` (a JSONL file handle) and referenced by "student_id:problem".
     """
-    conversation_history = [
-        {"role": "user", "parts": [{"text": f"[Instructions]\n{SYSTEM_PROMPT}"}]},
-        {"role": "model", "parts": [{"text": (
-            "Understood. I will simulate a student solving problems."
-        )}]},
-    ]
+    conversation_history = ConversationHistory()
 
     results = []
-
-    for idx, row in student_problems.iterrows():
+    # Ground truth for the previous problem, delivered with the next problem
+    # rather than in a round trip of its own (its reply was never used)
+    pending_feedback = None
+    # Problems left before compaction is retried after a failed summary call
+    compaction_cooldown = 0
+
+    # Ground-truth columns are already normalized by run_pipeline
+    for row in student_problems.itertuples(index=False):
         problem_num = len(results) + 1
-        student_id = row["student_id"]
-        problem_text = row["problem_text"]
-        gt_strategy = str(row["correct_strategy"]).strip().lower()
-        gt_unknown = str(row["correct_unknown"]).strip().lower()
-        gt_answer = str(row["correct_answer"]).strip().lower()
-
-        print(f"  Problem {problem_num}...")
-
-        # Step 1: Send problem
-        response_text = call_gemini(client, model, conversation_history, problem_text)
+        student_id = row.student_id
+        problem_text = row.problem_text
+        gt_strategy = row.correct_strategy
+        gt_unknown = row.correct_unknown
+        gt_answer = row.correct_answer
+
+        print(f"  [{student_id}] Problem {problem_num}...")
+
+        if compaction_cooldown > 0:
+            compaction_cooldown -= 1
+        elif not await compact_history(
+            client, model, conversation_history, prompt_cache
+        ):
+            compaction_cooldown = COMPACTION_COOLDOWN_PROBLEMS
+
+        # Send problem, prefixed with the previous problem's ground truth
+        message_text = problem_text
+        if pending_feedback is not None:
+            message_text = f"{pending_feedback}\n\nNEXT PROBLEM:\n{problem_text}"
+        response_text = await call_gemini(
+            client, model, conversation_history, message_text, prompt_cache
+        )
 
         if response_text is None:
             parsed = {k: None for k in [
@@ -168,11 +371,17 @@ def run_student_session(client, model, student_problems: pd.DataFrame) -> list[d
             if parsed["gemini_correct_answer"] is not None else None
         )
 
+        raw_ref = f"{student_id}:{problem_num}"
+        if raw_log is not None:
+            raw_log.write(json.dumps({
+                "sid": student_id, "pn": problem_num, "text": response_text,
+            }) + "\n")
+
         results.append({
             "student_id": student_id,
             "problem_number": problem_num,
             "problem_text": problem_text,
-            "cluster_number": row['cluster_number'],
+            "cluster_number": row.cluster_number,
             # Gemini self-assessments (yes/no)
             "gemini_optimal_strategy": parsed["gemini_optimal_strategy"],
             "gemini_solved_unknown": parsed["gemini_solved_unknown"],
@@ -185,30 +394,102 @@ def run_student_session(client, model, student_problems: pd.DataFrame) -> list[d
             "strategy_match": strategy_match,
             "unknown_match": unknown_match,
             "answer_match": answer_match,
-            # Raw response for debugging
-            "gemini_raw_response": response_text,
+            # Key into the raw response log for debugging
+            "gemini_raw_response_ref": raw_ref,
         })
 
-        # Step 2: Feed ground truth back
-        feedback = (
-            f"Here is the correct information for this problem:\n"
-            f"- The student used the optimal strategy: {gt_strategy}\n"
-            f"- The student solved for the unknown with no errors: {gt_unknown}\n"
-            f"- The student obtained the correct final answer with no errors: {gt_answer}\n"
-            f"Use this to adjust your reasoning for the next problem based on "
-            f"the student's learning trajectory."
-        )
-        call_gemini(client, model, conversation_history, feedback)
+        # Queue ground truth for the next problem; if this call failed the model
+        # never saw the problem, so keep whatever feedback is still undelivered
+        if response_text is not None:
+            pending_feedback = (
+                f"Here is the correct information for this problem:\n"
+                f"- The student used the optimal strategy: {gt_strategy}\n"
+                f"- The student solved for the unknown with no errors: {gt_unknown}\n"
+                f"- The student obtained the correct final answer with no errors: {gt_answer}\n"
+                f"Use this to adjust your reasoning for the next problem based on "
+                f"the student's learning trajectory."
+            )
 
     return results
 
 
+# ── Result Writers ─────────────────────────────────────────────────────────────
+class CsvResultWriter:
+    """Appends each student's rows to a CSV file with a fixed header."""
+
+    def __init__(self, path):
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        # "\n" endings, as DataFrame.to_csv wrote them (DictWriter defaults to "\r\n")
+        self._writer = csv.DictWriter(
+            self._file, fieldnames=RESULT_COLUMNS, lineterminator="\n"
+        )
+        self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetResultWriter:
+    """
+    Streams each student's rows into a zstd-compressed Parquet file (needs
+    pyarrow). Columns copied from the input frame take their types from it.
+    """
+
+    def __init__(self, path, df: pd.DataFrame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        yes_no = pa.string()
+        passthrough = pa.Schema.from_pandas(
+            df[["student_id", "problem_text", "cluster_number"]], preserve_index=False
+        )
+        self._pa = pa
+        self._schema = pa.schema([
+            passthrough.field("student_id"),
+            ("problem_number", pa.int64()),
+            passthrough.field("problem_text"),
+            passthrough.field("cluster_number"),
+            ("gemini_optimal_strategy", yes_no),
+            ("gemini_solved_unknown", yes_no),
+            ("gemini_correct_answer", yes_no),
+            ("correct_strategy", yes_no),
+            ("correct_unknown", yes_no),
+            ("correct_answer", yes_no),
+            ("strategy_match", pa.bool_()),
+            ("unknown_match", pa.bool_()),
+            ("answer_match", pa.bool_()),
+            ("gemini_raw_response_ref", pa.string()),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema, compression="zstd")
+
+    def write(self, rows):
+        if rows:
+            self._writer.write_table(
+                self._pa.Table.from_pylist(rows, schema=self._schema)
+            )
+
+    def close(self):
+        self._writer.close()
+
+
+def open_result_writer(save_path, df: pd.DataFrame):
+    """Pick the output format from the file extension (.parquet or CSV)."""
+    if save_path.endswith(".parquet"):
+        return ParquetResultWriter(save_path, df)
+    return CsvResultWriter(save_path)
+
 
 def run_pipeline(
     df: pd.DataFrame,
     api_key: str = API_KEY,
     model: str = MODEL,
-    save_path: str = "evaluation_results.csv"
+    save_path: str = "evaluation_results.csv",
+    max_concurrency: int = MAX_CONCURRENT_STUDENTS,
+    raw_log_path: str | None = None,
 ) -> pd.DataFrame:
     """
     Main entry point.
@@ -220,27 +501,109 @@ def run_pipeline(
     Parameters
     ----------
     save_path : str
-        CSV path for incremental saves after each student.
+        Output path; each student's rows are appended as their session
+        finishes. A ``.parquet`` path writes Parquet (requires pyarrow),
+        anything else writes CSV.
+    max_concurrency : int
+        Maximum number of student sessions in flight at once. Lower it if the
+        project's requests-per-minute quota is being hit.
+    raw_log_path : str, optional
+        JSONL file receiving each raw Gemini response as
+        {"sid", "pn", "text"}; results keep only a "student_id:problem" key.
+        Defaults to ``<save_path stem>.raw.jsonl`` next to save_path.
 
     Returns a results DataFrame.
+
+    This drives its own event loop, so it cannot be called from one that is
+    already running (e.g. Jupyter); await run_pipeline_async there instead.
     """
-    client = genai.Client(api_key=api_key)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError(
+            "run_pipeline() cannot be called from a running event loop; "
+            "use `await run_pipeline_async(...)` instead."
+        )
+    return asyncio.run(
+        run_pipeline_async(
+            df, api_key, model, save_path, max_concurrency, raw_log_path
+        )
+    )
 
-    all_results = []
-    students = list(df["student_id"].unique())
 
-    print(f"Running pipeline for {len(students)} students...\n")
+async def run_pipeline_async(
+    df: pd.DataFrame,
+    api_key: str = API_KEY,
+    model: str = MODEL,
+    save_path: str = "evaluation_results.csv",
+    max_concurrency: int = MAX_CONCURRENT_STUDENTS,
+    raw_log_path: str | None = None,
+) -> pd.DataFrame:
+    """
+    Awaitable form of run_pipeline, for callers already inside an event loop.
+    Student sessions run concurrently, at most max_concurrency at a time.
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+
+    if raw_log_path is None:
+        raw_log_path = os.path.splitext(save_path)[0] + ".raw.jsonl"
 
-    for i, student_id in enumerate(students):
-        student_df = df[df["student_id"] == student_id].copy()
-        student_results = run_student_session(client, model, student_df)
-        all_results.extend(student_results)
+    # Normalize ground-truth labels once for the whole frame
+    df = df.assign(**{
+        col: df[col].astype(str).str.strip().str.lower()
+        for col in GROUND_TRUTH_COLUMNS
+    })
 
-        # Save after each student
-        results_df = pd.DataFrame(all_results)
-        results_df.to_csv(save_path, index=False)
+    students = df.groupby("student_id", sort=False)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_one(student_df):
+        async with semaphore:
+            student_results = await run_student_session(
+                client, model, student_df, prompt_cache, raw_log
+            )
 
-    results_df = pd.DataFrame(all_results)
+        # Append this student's rows as soon as the session finishes, flushing
+        # the raw log first so every written ref points at a saved response
+        raw_log.flush()
+        writer.write(student_results)
+        return student_results
+
+    writer = raw_log = prompt_cache = None
+    try:
+        writer = open_result_writer(save_path, df)
+        raw_log = open(raw_log_path, "w", encoding="utf-8")
+        client = genai.Client(api_key=api_key)
+        prompt_cache = await create_prompt_cache(client, model)
+
+        print(f"Running pipeline for {students.ngroups} students...\n")
+
+        tasks = [
+            asyncio.create_task(run_one(student_df)) for _, student_df in students
+        ]
+        try:
+            # gather preserves student order for the returned frame
+            per_student = await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the other sessions before their files and cache go away
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    finally:
+        if writer is not None:
+            writer.close()
+        if raw_log is not None:
+            raw_log.close()
+        if prompt_cache is not None:
+            await delete_prompt_cache(client, prompt_cache)
+
+    results_df = pd.DataFrame(
+        [r for results in per_student for r in results], columns=RESULT_COLUMNS
+    )
     return results_df
 
 